@@ -1,8 +1,13 @@
 import os
-import hashlib
-from typing import List, Dict, Generator, Optional
-from PyPDF2 import PdfReader
+import re
+from functools import lru_cache
+from secrets import token_hex
+from typing import List, Dict, Set, Generator, Optional, Tuple, Callable, Iterator
+import httpx
+import numpy as np
 from openai import OpenAI
+from rank_bm25 import BM25Okapi
+from pdf_parser_v2 import extract_text_pages
 import logging
 import json
 import streamlit as st
@@ -11,34 +16,204 @@ import streamlit as st
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# System prompts, selected per question language
+_SYSTEM_PROMPT_TH = """คุณคือผู้เชี่ยวชาญด้านการวิเคราะห์เอกสารประกวดราคาอิเล็กทรอนิกส์ภาครัฐของไทย consultant
+
+**เป้าหมายของคุณคือ:**
+1.  วิเคราะห์เอกสารประกวดราคาซื้อด้วยวิธีประกวดราคาอิเล็กทรอนิกส์ (e-bidding document) ที่แนบมานี้ (ซึ่งต่อไปจะเรียกว่า "เอกสาร")
+2.  เมื่อได้รับคำถามจากผู้เสนอราคา (Bidder) ให้ค้นหาส่วน ข้อ หรือข้อความที่เกี่ยวข้องและตรงประเด็นที่สุดใน "เอกสาร" เพื่อใช้เป็นคำตอบ
+3.  คำตอบของคุณจะต้องเป็นข้อความภาษาไทยเดิมจากเอกสาร (Direct Quote) พร้อมระบุหมายเลขข้อหรือแหล่งที่มา (Source/Citation) อย่างชัดเจน
+4.  ห้ามให้ข้อมูลที่ไม่อยู่ในเอกสารที่กำหนดให้วิเคราะห์
+
+**หากเหมาะสมรูปแบบการตอบกลับที่ต้องการ:**
+-   ระบุคำถามของผู้เสนอราคา (Question)
+-   ให้คำตอบที่สรุปเป็น point form (Summary Answer)
+-   ระบุข้อความที่ตรงตามเงื่อนไข (Exact Sentence from pdf)
+-   ระบุแหล่งที่มา (Source/Citation)
+
+**หากเหมาะสมตัวอย่างการตอบกลับ:**
+**Question:** ...
+**Summary Answer:** ...
+**Exact Sentence:** ...
+**Source/Citation:** [ข้อ X.Y]"""
+
+_SYSTEM_PROMPT_EN = """You are an expert specialist in analyzing Thai government e-bidding documents.
+
+**Your objectives are:**
+1. Analyze the e-bidding purchase document provided to you (hereinafter called "Document")
+2. When you receive a question from a Bidder, search for the most relevant and applicable section, clause, or text in the "Document" to answer it
+3. Your answer must be the original text from the document (Direct Quote) with a clear citation of the clause number or source
+4. Do not provide information that is not in the provided document
+
+**Response format:**
+- State the Bidder's question (Question)
+- Provide a summarized answer in point form (Summary Answer)
+- Provide the exact relevant sentence(s) from the document (Exact Sentence from Document)
+- Cite the source (Source/Citation)
+
+**Example response format:**
+**Question:** ...
+**Summary Answer:** ...
+**Exact Sentence:** ...
+**Source/Citation:** [Clause X.Y]"""
+
+def _load_config() -> Tuple[Optional[str], str, str, str]:
+    """
+    Read API key, base URL, chat model and embedding model from Streamlit
+    secrets or the environment
+    """
+    try:
+        return (
+            st.secrets.get("API_KEY"),
+            st.secrets.get("BASE_URL", "https://dashscope-intl.aliyuncs.com/compatible-mode/v1"),
+            st.secrets.get("DEFAULT_MODEL", "qwen3-max"),
+            st.secrets.get("EMBEDDING_MODEL", "text-embedding-v3"),
+        )
+    except (AttributeError, FileNotFoundError):
+        # Fallback for non-Streamlit contexts (e.g., testing)
+        from dotenv import load_dotenv
+        load_dotenv()
+        return (
+            os.getenv("API_KEY"),
+            os.getenv("BASE_URL", "https://dashscope-intl.aliyuncs.com/compatible-mode/v1"),
+            os.getenv("DEFAULT_MODEL", "qwen3-max"),
+            os.getenv("EMBEDDING_MODEL", "text-embedding-v3"),
+        )
+
+def _build_openai_client(api_key: str, base_url: str) -> OpenAI:
+    """
+    Create the OpenAI client on an HTTP/2 connection pool sized for
+    concurrent streaming sessions
+    """
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+# Configuration is read once per process. Every ChatClient shares one OpenAI
+# client, so session resets reuse its pooled connections instead of paying
+# a fresh TCP + TLS handshake
+_API_KEY, _BASE_URL, _DEFAULT_MODEL, _EMBEDDING_MODEL = _load_config()
+_SHARED_OPENAI_CLIENT = _build_openai_client(_API_KEY, _BASE_URL) if _API_KEY else None
+
+# Thai script runs, and word runs of any other script
+_THAI_RUN_RE = re.compile(r'[\u0E00-\u0E7F]+')
+_TOKEN_RE = re.compile(r'[\u0E00-\u0E7F]+|[^\W\u0E00-\u0E7F]+')
+
+def _tokenize(text: str) -> List[str]:
+    """
+    Tokenize text for BM25: lowercase words for English, overlapping
+    character bigrams for Thai, which is written without spaces
+    """
+    tokens = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if _THAI_RUN_RE.match(run):
+            tokens.extend(run[i:i + 2] for i in range(max(1, len(run) - 1)))
+        else:
+            tokens.append(run)
+    return tokens
+
+# Hybrid retrieval: weight of embedding similarity against normalized BM25
+_DENSE_WEIGHT = 0.6
+_EMBED_BATCH_SIZE = 10  # Largest batch DashScope's text-embedding-v3 accepts
+_EMBED_MAX_CHARS = 6000  # Keep each input under the embedding model's token limit
+
+# Streamed deltas are yielded once this many characters have accumulated
+# (or a newline arrives), instead of one generator round-trip per token
+_STREAM_FLUSH_CHARS = 32
+
+@lru_cache(maxsize=256)
+def _tokenize_query(query: str) -> Tuple[str, ...]:
+    """
+    Tokenize a question; suggested questions repeat, so results are cached
+    """
+    return tuple(_tokenize(query))
+
+def _normalize_scores(scores: np.ndarray) -> np.ndarray:
+    """
+    Scale non-negative scores to [0, 1] so they can be fused with cosine similarity
+    """
+    top = scores.max()
+    return scores / top if top > 0 else scores
+
+class SessionLimitReached(Exception):
+    """Raised by chat_with_dashscope when the session has no questions left"""
+
+class ChatStreamError(Exception):
+    """Raised by chat_with_dashscope when the request fails, after any reply
+    text received so far has been yielded"""
+
+class PromptBuffer:
+    """
+    Conversation history as a committed prefix of finished turns plus a
+    tail holding the turn still in flight, with running token estimates so
+    the per-turn count is O(1) instead of a walk over the whole history
+    """
+    def __init__(self, estimate_tokens: Callable[[str], int]):
+        self._estimate_tokens = estimate_tokens
+        self.prefix_msgs: List[Dict[str, str]] = []
+        self.prefix_token_sum = 0
+        self.tail_msgs: List[Dict[str, str]] = []
+        self.tail_token_sum = 0
+
+    def append_user(self, content: str):
+        """
+        Add a question to the tail; it stays there until its answer arrives
+        """
+        self.tail_msgs.append({"role": "user", "content": content})
+        self.tail_token_sum += self._estimate_tokens(content)
+
+    def commit_assistant(self, content: str):
+        """
+        Move the tail and its answer into the committed prefix
+        """
+        self.prefix_msgs.extend(self.tail_msgs)
+        self.prefix_msgs.append({"role": "assistant", "content": content})
+        self.prefix_token_sum += self.tail_token_sum + self._estimate_tokens(content)
+        self.tail_msgs = []
+        self.tail_token_sum = 0
+
+    def build_messages(self, head: List[Dict[str, str]],
+                       context: Optional[List[Dict[str, str]]] = None) -> List[Dict[str, str]]:
+        """
+        Return head (system messages), the prefix, then any per-question
+        context messages just before the tail
+        """
+        return [*head, *self.prefix_msgs, *(context or []), *self.tail_msgs]
+
+    def token_estimate(self) -> int:
+        return self.prefix_token_sum + self.tail_token_sum
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        yield from self.prefix_msgs
+        yield from self.tail_msgs
+
+    def __len__(self) -> int:
+        return len(self.prefix_msgs) + len(self.tail_msgs)
+
 class ChatClient:
     def __init__(self):
-        # Initialize API configuration from Streamlit secrets
-        try:
-            self.api_key = st.secrets.get("API_KEY")
-            self.base_url = st.secrets.get("BASE_URL", "https://dashscope-intl.aliyuncs.com/compatible-mode/v1")
-            self.default_model = st.secrets.get("DEFAULT_MODEL", "qwen3-max")
-        except (AttributeError, FileNotFoundError):
-            # Fallback for non-Streamlit contexts (e.g., testing)
-            from dotenv import load_dotenv
-            load_dotenv()
-            self.api_key = os.getenv("API_KEY")
-            self.base_url = os.getenv("BASE_URL", "https://dashscope-intl.aliyuncs.com/compatible-mode/v1")
-            self.default_model = os.getenv("DEFAULT_MODEL", "qwen3-max")
-
-        # Initialize client
-        if self.api_key:
-            self.client = OpenAI(
-                api_key=self.api_key,
-                base_url=self.base_url,
-            )
-        else:
-            self.client = None
+        # API configuration and client are shared across sessions
+        self.api_key = _API_KEY
+        self.base_url = _BASE_URL
+        self.default_model = _DEFAULT_MODEL
+        self.embedding_model = _EMBEDDING_MODEL
+        self.client = _SHARED_OPENAI_CLIENT
         
         # Session state
-        self.conversation_history: List[Dict[str, str]] = []
+        self.conversation_history = PromptBuffer(self._estimate_tokens)
         self.knowledge_base: List[Dict[str, str]] = []
-        self.session_id = hashlib.md5(os.urandom(32)).hexdigest()
+        self._kb_contents: Set[str] = set()  # Contents already in the knowledge base
+        self._kb_revision = 0  # Bumped on every knowledge base change
+        self._context_cache: Optional[Tuple[tuple, str]] = None
+        self._bm25: Optional[BM25Okapi] = None
+        self._kb_embeddings: Optional[np.ndarray] = None  # (N, D) float32, unit rows
+        self._embedding_cache: Dict[str, np.ndarray] = {}  # content -> unit vector
+        self._index_key: Optional[Tuple[int, int]] = None
+        self.retrieval_top_k = 5  # Knowledge items sent with each question
+        self.session_id = token_hex(16)
         self.question_count = 1  # Track number of questions asked
         self.max_questions = 10   # Maximum questions allowed per session
     
@@ -46,49 +221,157 @@ class ChatClient:
         """
         Extract text from a PDF file
         """
-        pdf_reader = PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
-        return text
+        return "".join(extract_text_pages(pdf_file.read()))
     
     def add_knowledge(self, content: str, source: str = "PDF"):
         """
-        Add content to the knowledge base
+        Add content to the knowledge base, skipping content already present
         """
+        if content in self._kb_contents:
+            return
         self.knowledge_base.append({
             "content": content,
             "source": source
         })
+        self._kb_contents.add(content)
+        self._kb_revision += 1
+
+    def _section_text(self, section: Dict) -> str:
+        """
+        Format a parsed section as readable text
+        """
+        return f"Section {section.get('section_number', 'N/A')}: {section.get('title', 'Untitled')}\n\n{section.get('content', '')}"
     
     def add_structured_knowledge(self, sections: List[Dict], source: str = "PDF"):
         """
-        Add structured sections to the knowledge base
+        Add structured sections to the knowledge base, skipping sections
+        already present
         """
+        added = False
         for section in sections:
-            # Format section as readable text
-            section_text = f"Section {section.get('section_number', 'N/A')}: {section.get('title', 'Untitled')}\n\n{section.get('content', '')}"
+            section_text = self._section_text(section)
+            if section_text in self._kb_contents:
+                continue
             self.knowledge_base.append({
                 "content": section_text,
                 "source": f"{source} - Section {section.get('section_number', 'N/A')}",
                 "structured_data": section  # Keep structured data for future use
             })
+            self._kb_contents.add(section_text)
+            added = True
+        if added:
+            self._kb_revision += 1
+
+    def sync_structured_knowledge(self, sections: List[Dict], source: str = "PDF"):
+        """
+        Make the structured knowledge match sections exactly, removing the
+        ones no longer selected and adding only the new ones
+        """
+        wanted = {self._section_text(section) for section in sections}
+        kept = [
+            item for item in self.knowledge_base
+            if "structured_data" not in item or item["content"] in wanted
+        ]
+        if len(kept) != len(self.knowledge_base):
+            self.knowledge_base = kept
+            self._kb_contents = {item["content"] for item in kept}
+            self._kb_revision += 1
+        self.add_structured_knowledge(sections, source)
     
-    def _get_context(self) -> str:
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed texts through the OpenAI-compatible embeddings endpoint as
+        L2-normalized float32 rows, so cosine similarity is a dot product
+        """
+        rows = []
+        for start in range(0, len(texts), _EMBED_BATCH_SIZE):
+            batch = [text[:_EMBED_MAX_CHARS] for text in texts[start:start + _EMBED_BATCH_SIZE]]
+            response = self.client.embeddings.create(model=self.embedding_model, input=batch)
+            rows.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        vectors = np.asarray(rows, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def _embed_contents(self, contents: List[str]) -> np.ndarray:
+        """
+        Embed knowledge items, calling the API only for content not embedded
+        before, so section toggles re-embed just the added sections
+        """
+        missing = [content for content in dict.fromkeys(contents) if content not in self._embedding_cache]
+        if missing:
+            self._embedding_cache.update(zip(missing, self._embed(missing)))
+        return np.stack([self._embedding_cache[content] for content in contents])
+
+    def _embed_query(self, query: str) -> Optional[np.ndarray]:
+        """
+        Embed the question, or return None when embeddings are unavailable
+        """
+        if self._kb_embeddings is None:
+            return None
+        try:
+            return self._embed([query])[0]
+        except Exception as e:
+            logger.warning(f"Query embedding failed, using BM25 only: {e}")
+            return None
+
+    def _retrieve(self, query: str) -> Tuple[int, ...]:
+        """
+        Pick the indices of the knowledge items most relevant to the query
+        using embedding similarity fused with BM25, in knowledge base order
         """
-        Get relevant context from knowledge base
+        if len(self.knowledge_base) <= self.retrieval_top_k:
+            return tuple(range(len(self.knowledge_base)))
+
+        # The index only changes when knowledge is added or the list is replaced
+        kb_key = (id(self.knowledge_base), self._kb_revision)
+        if self._index_key != kb_key:
+            contents = [item["content"] for item in self.knowledge_base]
+            self._bm25 = BM25Okapi([_tokenize(content) for content in contents])
+            try:
+                self._kb_embeddings = self._embed_contents(contents)
+            except Exception as e:
+                logger.warning(f"Knowledge base embedding failed, using BM25 only: {e}")
+                self._kb_embeddings = None
+            self._index_key = kb_key
+
+        scores = self._bm25.get_scores(list(_tokenize_query(query)))
+        query_embedding = self._embed_query(query)
+        if query_embedding is not None:
+            # Embeddings match across languages ("qualifications" vs
+            # "คุณสมบัติ"), which BM25 alone cannot
+            scores = (_DENSE_WEIGHT * (self._kb_embeddings @ query_embedding)
+                      + (1 - _DENSE_WEIGHT) * _normalize_scores(scores))
+        elif not scores.any():
+            # No lexical overlap at all (e.g. an English question about a
+            # Thai document), so fall back to sending everything
+            return tuple(range(len(self.knowledge_base)))
+        top_k = np.argpartition(scores, -self.retrieval_top_k)[-self.retrieval_top_k:]
+        return tuple(sorted(int(i) for i in top_k))
+
+    def _get_context(self, query: str) -> Tuple[str, bool]:
+        """
+        Get the knowledge base context relevant to the query, and whether
+        retrieval narrowed it to a subset of the knowledge base
         """
         if not self.knowledge_base:
-            return ""
-        
-        # For simplicity, we're using all knowledge as context
-        # In a production environment, you'd want to implement
-        # a more sophisticated retrieval mechanism
+            return "", False
+
+        indices = self._retrieve(query)
+        narrowed = len(indices) < len(self.knowledge_base)
+
+        # Consecutive questions often hit the same sections, so reuse the
+        # rendered text until the selection or the knowledge base changes
+        cache_key = (id(self.knowledge_base), self._kb_revision, indices)
+        if self._context_cache is not None and self._context_cache[0] == cache_key:
+            return self._context_cache[1], narrowed
+
         context_parts = []
-        for item in self.knowledge_base:
+        for i in indices:
+            item = self.knowledge_base[i]
             context_parts.append(f"Source: {item['source']}\nContent: {item['content']}")
         
-        return "\n\n".join(context_parts)
+        context = "\n\n".join(context_parts)
+        self._context_cache = (cache_key, context)
+        return context, narrowed
     
     def _estimate_tokens(self, text: str) -> int:
         """
@@ -105,86 +388,62 @@ class ChatClient:
         Args:
             message: The user's question
             language: "thai" or "english" to select appropriate system prompt
+
+        Raises:
+            SessionLimitReached: The session has used all its questions
+            ChatStreamError: The request failed; raised after any partial reply
         """
         if not self.client:
             raise ValueError("DashScope API key not configured")
 
         # Check if we've reached the question limit
         if self.question_count >= self.max_questions:
-            yield "Session limit reached. You have used all 10 questions. The session will now reset."
             self.reset_session()
-            return
-
-        # Add context to the message if we have knowledge base
-        context = self._get_context()
-        if context:
-            full_message = f"Use the following context to answer the question:\n\n{context}\n\nQuestion: {message}"
-        else:
-            full_message = message
+            raise SessionLimitReached("Session limit reached. You have used all 10 questions. The session will now reset.")
 
         # Add to conversation history
-        self.conversation_history.append({"role": "user", "content": message})
+        self.conversation_history.append_user(message)
         self.question_count += 1  # Increment question count
 
         # Select system prompt based on language
-        if language.lower() == "thai":
-            system_prompt = """คุณคือผู้เชี่ยวชาญด้านการวิเคราะห์เอกสารประกวดราคาอิเล็กทรอนิกส์ภาครัฐของไทย consultant
-
-**เป้าหมายของคุณคือ:**
-1.  วิเคราะห์เอกสารประกวดราคาซื้อด้วยวิธีประกวดราคาอิเล็กทรอนิกส์ (e-bidding document) ที่แนบมานี้ (ซึ่งต่อไปจะเรียกว่า "เอกสาร")
-2.  เมื่อได้รับคำถามจากผู้เสนอราคา (Bidder) ให้ค้นหาส่วน ข้อ หรือข้อความที่เกี่ยวข้องและตรงประเด็นที่สุดใน "เอกสาร" เพื่อใช้เป็นคำตอบ
-3.  คำตอบของคุณจะต้องเป็นข้อความภาษาไทยเดิมจากเอกสาร (Direct Quote) พร้อมระบุหมายเลขข้อหรือแหล่งที่มา (Source/Citation) อย่างชัดเจน
-4.  ห้ามให้ข้อมูลที่ไม่อยู่ในเอกสารที่กำหนดให้วิเคราะห์
-
-**หากเหมาะสมรูปแบบการตอบกลับที่ต้องการ:**
--   ระบุคำถามของผู้เสนอราคา (Question)
--   ให้คำตอบที่สรุปเป็น point form (Summary Answer)
--   ระบุข้อความที่ตรงตามเงื่อนไข (Exact Sentence from pdf)
--   ระบุแหล่งที่มา (Source/Citation)
-
-**หากเหมาะสมตัวอย่างการตอบกลับ:**
-**Question:** ...
-**Summary Answer:** ...
-**Exact Sentence:** ...
-**Source/Citation:** [ข้อ X.Y]"""
-        else:  # English
-            system_prompt = """You are an expert specialist in analyzing Thai government e-bidding documents.
-
-**Your objectives are:**
-1. Analyze the e-bidding purchase document provided to you (hereinafter called "Document")
-2. When you receive a question from a Bidder, search for the most relevant and applicable section, clause, or text in the "Document" to answer it
-3. Your answer must be the original text from the document (Direct Quote) with a clear citation of the clause number or source
-4. Do not provide information that is not in the provided document
-
-**Response format:**
-- State the Bidder's question (Question)
-- Provide a summarized answer in point form (Summary Answer)
-- Provide the exact relevant sentence(s) from the document (Exact Sentence from Document)
-- Cite the source (Source/Citation)
-
-**Example response format:**
-**Question:** ...
-**Summary Answer:** ...
-**Exact Sentence:** ...
-**Source/Citation:** [Clause X.Y]"""
+        system_prompt = _SYSTEM_PROMPT_TH if language.lower() == "thai" else _SYSTEM_PROMPT_EN
         
-        messages = [{"role": "system", "content": system_prompt}]
-        for msg in self.conversation_history[:-1]:  # All but the last one
-            messages.append(msg)
-        messages.append({"role": "user", "content": full_message})
+        # Keep the system prompt, document context and committed history as
+        # a byte-identical prefix across turns so the provider's prompt cache
+        # can reuse it. Context that retrieval narrowed depends on the
+        # question, so it goes after the history, right before the question
+        head = [{"role": "system", "content": system_prompt}]
+        context, narrowed = self._get_context(message)
+        context_msgs = []
+        if context:
+            context_msg = {"role": "system", "content": f"Document context:\n{context}"}
+            if narrowed:
+                context_msgs.append(context_msg)
+            else:
+                head.append(context_msg)
+        messages = self.conversation_history.build_messages(head, context_msgs)
         
         # Estimate input tokens
-        input_text = "\n".join([msg["content"] for msg in messages])
-        input_tokens = self._estimate_tokens(input_text)
+        input_tokens = (
+            sum(self._estimate_tokens(msg["content"]) for msg in head)
+            + sum(self._estimate_tokens(msg["content"]) for msg in context_msgs)
+            + self.conversation_history.token_estimate()
+        )
         
         logger.info(f"Sending request with model: {self.default_model}")
         logger.info(f"Language: {language}")
         logger.info(f"Input tokens (estimated): {input_tokens}")
-        logger.info(f"Messages: {messages}")
         logger.info(f"Base URL: {self.base_url}")
         logger.info(f"Question count: {self.question_count}/{self.max_questions}")
+        # Formatting per-chunk and full-prompt logs is costly, so only do it
+        # when debug logging is actually on
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(f"Messages: {messages}")
         
         # Stream response
+        parts: List[str] = []
+        pending = ""  # Tiny deltas are coalesced before being yielded
         try:
             response = self.client.chat.completions.create(
                 model=self.default_model,
@@ -195,50 +454,64 @@ class ChatClient:
                 # top_p=0.8  # Low top_p for more focused responses
             )
             
-            full_response = ""
             chunk_count = 0
             
             for chunk in response:
                 chunk_count += 1
-                logger.debug(f"Received chunk {chunk_count}: {chunk}")
+                if debug:
+                    logger.debug(f"Received chunk {chunk_count}: {chunk}")
                 
                 # Check if we have choices
-                if chunk.choices and len(chunk.choices) > 0:
+                if chunk.choices:
                     delta = chunk.choices[0].delta
                     if delta and delta.content:
                         content = delta.content
-                        logger.debug(f"Chunk {chunk_count} content: {content}")
-                        full_response += content
-                        yield content
+                        parts.append(content)
+                        pending += content
+                        if len(pending) >= _STREAM_FLUSH_CHARS or "\n" in content:
+                            yield pending
+                            pending = ""
                 elif chunk.usage:
                     logger.info(f"Usage information: {chunk.usage}")
                     if hasattr(chunk.usage, 'prompt_tokens'):
                         logger.info(f"Actual prompt tokens: {chunk.usage.prompt_tokens}")
             
+            if pending:
+                yield pending
+                pending = ""
+            full_response = "".join(parts)
             logger.info(f"Completed streaming. Total chunks: {chunk_count}, Total response length: {len(full_response)}")
-            logger.debug(f"Full response: {full_response}")
+            if debug:
+                logger.debug(f"Full response: {full_response}")
             
             # Add to conversation history
-            self.conversation_history.append({"role": "assistant", "content": full_response})
+            self.conversation_history.commit_assistant(full_response)
             
             # If this was the last allowed question, notify the user
             if self.question_count >= self.max_questions:
                 yield "\n\n[INFO: You have used all 10 questions. The session will reset after this response.]"
             
         except Exception as e:
+            if pending:
+                yield pending
             error_msg = f"Error: {str(e)}"
             logger.error(error_msg, exc_info=True)
-            yield error_msg
+            # Raised rather than yielded, so the failure can never be
+            # mistaken for reply text that happens to start with "Error:"
+            raise ChatStreamError(error_msg) from e
     
     def reset_session(self):
         """
         Reset the conversation history and knowledge base
         """
         logger.info("Resetting session")
-        self.conversation_history = []
+        self.conversation_history = PromptBuffer(self._estimate_tokens)
         self.knowledge_base = []
+        self._kb_contents = set()
+        self._kb_revision += 1
+        self._context_cache = None
         self.question_count = 0
-        self.session_id = hashlib.md5(os.urandom(32)).hexdigest()
+        self.session_id = token_hex(16)
     
     def get_question_count(self):
         """
@@ -1,38 +1,16 @@
 import streamlit as st
-from chat_client import ChatClient
-import os
+from chat_client import ChatClient, ChatStreamError, SessionLimitReached
 import hashlib
-import time
 import logging
-import tempfile
-import json
-from pdf_parser_v2 import extract_text_from_pdf, parse_document
+import time
+from pdf_parser_v2 import extract_text_pages, parse_document
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize session state
-if "chat_client" not in st.session_state:
-    st.session_state.chat_client = ChatClient()
-
-if "session_id" not in st.session_state:
-    st.session_state.session_id = st.session_state.chat_client.session_id
-
-# Check if session was reset (page refresh)
-if st.session_state.session_id != st.session_state.chat_client.session_id:
-    st.session_state.chat_client = ChatClient()
-    st.session_state.session_id = st.session_state.chat_client.session_id
-
-# Set page config
-st.set_page_config(
-    page_title="Streamlit Chatbot",
-    page_icon="🤖",
-    layout="wide"
-)
-
 # Custom CSS for compact UI
-st.markdown("""
+_CSS = """
 <style>
     /* Reduce default spacing and font sizes */
     .block-container {
@@ -81,7 +59,56 @@ st.markdown("""
         font-size: 0.9rem !important;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# Redraw the streaming reply once this many chunks or seconds have built up;
+# every redraw resends the whole reply so far over the websocket
+_RENDER_EVERY_CHUNKS = 8
+_RENDER_INTERVAL = 0.05
+
+# Paired Thai and English suggested questions, built once per process
+QUESTION_PAIRS = (
+    ("คุณสมบัติหลักของผู้ยื่นข้อเสนอ/ผู้เข้าร่วมประมูล มีอะไรบ้าง? (สรุป)", "What are the main qualifications of bidders/participants? (Summarized)"),
+    ("ผู้ยื่นข้อเสนอต้องแสดงหลักฐานทางการเงิน / หลักประกันการเสนอราคาเป็นจำนวนเท่าใด?", "How much financial proof / bid security must be provided?"),
+    ("หลักประกันการเสนอราคา / หลักฐานทางการเงินที่ยอมรับมีรูปแบบใดบ้าง?", "What are acceptable form of financial proof / bid security?"),
+    ("ผู้ยื่นข้อเสนอต้องมีผลงานหรือประสบการณ์ย้อนหลังกี่ปี?", "How many years of company background work or experience are required?"),
+    ("การตัดสินผู้ชนะพิจารณาจากราคาต่ำสุดหรือเกณฑ์การให้คะแนน?", "Is the winner determined by lowest price or scoring criteria?"),
+)
+THAI_QUESTIONS = tuple(thai_q for thai_q, english_q in QUESTION_PAIRS)
+ENGLISH_QUESTIONS = tuple(english_q for thai_q, english_q in QUESTION_PAIRS)
+
+# Sections added to the knowledge base when a PDF is first processed
+DEFAULT_SECTIONS = frozenset({"2", "4", "5", "6"})
+
+# Initialize session state
+if "chat_client" not in st.session_state:
+    st.session_state.chat_client = ChatClient()
+
+if "session_id" not in st.session_state:
+    st.session_state.session_id = st.session_state.chat_client.session_id
+
+# Check if session was reset (page refresh)
+if st.session_state.session_id != st.session_state.chat_client.session_id:
+    st.session_state.chat_client = ChatClient()
+    st.session_state.session_id = st.session_state.chat_client.session_id
+
+# Set page config
+st.set_page_config(
+    page_title="Streamlit Chatbot",
+    page_icon="🤖",
+    layout="wide"
+)
+
+# Custom CSS for compact UI. Emitted on every run: Streamlit removes any
+# element a rerun does not send, so caching the call would drop the styles
+st.markdown(_CSS, unsafe_allow_html=True)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _parse_pdf_cached(pdf_digest: str, _pdf_view: memoryview) -> dict:
+    """Extract and parse a PDF, shared across sessions uploading the same file"""
+    # Cached on the caller's BLAKE2b digest; the leading underscore keeps
+    # Streamlit from hashing the bytes again. Parses page by page from memory
+    return parse_document(extract_text_pages(_pdf_view))
 
 def main():
     st.title("🤖 Streamlit Chatbot with PDF Knowledge Base")
@@ -107,6 +134,8 @@ def main():
                     del st.session_state.selected_sections
                 if "show_section_selector" in st.session_state:
                     del st.session_state.show_section_selector
+                if "section_multiselect" in st.session_state:
+                    del st.session_state.section_multiselect
                 st.rerun()
 
         # Show question counter (compact)
@@ -129,39 +158,37 @@ def main():
         
         parsed_document = None
         if uploaded_file is not None:
-            # Check if this is a new file (different from what's already processed)
-            file_hash = hashlib.md5(uploaded_file.getvalue()).hexdigest()
-            if "last_processed_file_hash" not in st.session_state or st.session_state.last_processed_file_hash != file_hash:
+            # Check if this is a new file (different from what's already processed).
+            # Streamlit assigns every upload a stable file_id, so nothing is hashed
+            file_id = uploaded_file.file_id
+            if "last_processed_file_id" not in st.session_state or st.session_state.last_processed_file_id != file_id:
                 with st.spinner("Extracting text from PDF..."):
                     try:
-                        # Save uploaded file to temporary location
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                            tmp_file.write(uploaded_file.getvalue())
-                            tmp_file_path = tmp_file.name
-                        
-                        # Process PDF using parser
-                        text = extract_text_from_pdf(tmp_file_path)
-                        parsed_document = parse_document(text)
+                        # Hash and parse straight from the upload's buffer rather
+                        # than a getvalue() copy of the whole PDF
+                        with uploaded_file.getbuffer() as pdf_view:
+                            pdf_digest = hashlib.blake2b(pdf_view, digest_size=16).hexdigest()
+                            parsed_document = _parse_pdf_cached(pdf_digest, pdf_view)
                         
                         # Store parsed document in session state
                         st.session_state.parsed_document = parsed_document
-                        st.session_state.last_processed_file_hash = file_hash
+                        st.session_state.last_processed_file_id = file_id
                         
-                        # Initialize selected sections in session state
-                        default_sections = ["2", "4", "5", "6"]
-                        st.session_state.selected_sections = default_sections
+                        # Initialize selected sections in session state; kept as a
+                        # set of section numbers for membership checks
+                        st.session_state.selected_sections = DEFAULT_SECTIONS
+                        if "section_multiselect" in st.session_state:
+                            del st.session_state.section_multiselect
                         
                         # Automatically add default sections to knowledge base
+                        selected = st.session_state.selected_sections
                         selected_sections = [
                             section for section in st.session_state.parsed_document["sections"]
-                            if section["section_number"] in st.session_state.selected_sections
+                            if section["section_number"] in selected
                         ]
                         
                         st.session_state.chat_client.add_structured_knowledge(selected_sections, "PDF")
                         
-                        # Clean up temp file
-                        os.unlink(tmp_file_path)
-                        
                         st.success("PDF processed and default sections added to knowledge base!")
                     except Exception as e:
                         st.error(f"Error processing PDF: {str(e)}")
@@ -174,7 +201,6 @@ def main():
             if "sections" in st.session_state.parsed_document and st.session_state.parsed_document["sections"]:
                 if st.button("Select Sections to Include"):
                     st.session_state.show_section_selector = not st.session_state.get("show_section_selector", False)
-                    st.rerun()
                 
                 # Show section selector if requested
                 if st.session_state.get("show_section_selector", False):
@@ -183,28 +209,27 @@ def main():
                     
                     # Initialize selected sections in session state if not exists
                     if "selected_sections" not in st.session_state:
-                        st.session_state.selected_sections = ["2", "4", "5", "6"]  # Default selections
+                        st.session_state.selected_sections = DEFAULT_SECTIONS
                     
-                    # Create buttons for each section in a single column
-                    for section in st.session_state.parsed_document["sections"]:
-                        section_number = section['section_number']
-                        section_label = f"{section_number}. {section['title']}"
-                        
-                        # Determine if section is selected
-                        is_selected = section_number in st.session_state.selected_sections
-                        
-                        # Create button with color based on selection state
-                        if is_selected:
-                            # Use st.form to handle button clicks without page refresh issues
-                            if st.button(section_label, key=f"section_{section_number}", type="primary", use_container_width=True):
-                                # Remove from selected sections
-                                st.session_state.selected_sections.remove(section_number)
-                                st.rerun()
-                        else:
-                            if st.button(section_label, key=f"section_{section_number}", use_container_width=True):
-                                # Add to selected sections
-                                st.session_state.selected_sections.append(section_number)
-                                st.rerun()
+                    title_by_number = {
+                        section["section_number"]: section["title"]
+                        for section in st.session_state.parsed_document["sections"]
+                    }
+                    
+                    # Seed the widget from the current selection; Streamlit drops
+                    # its state whenever the selector is hidden
+                    if "section_multiselect" not in st.session_state:
+                        st.session_state.section_multiselect = [
+                            number for number in title_by_number if number in st.session_state.selected_sections
+                        ]
+                    
+                    # One widget for all sections, so toggling needs no rerun
+                    st.session_state.selected_sections = set(st.multiselect(
+                        "Sections",
+                        options=list(title_by_number),
+                        format_func=lambda number: f"{number}. {title_by_number[number]}",
+                        key="section_multiselect"
+                    ))
                     
                     # Show selected sections count
                     st.write(f"Selected {len(st.session_state.selected_sections)} sections")
@@ -214,20 +239,20 @@ def main():
                         with st.spinner("Updating knowledge base..."):
                             try:
                                 # Filter sections based on selection
+                                selected = st.session_state.selected_sections
                                 selected_sections = [
                                     section for section in st.session_state.parsed_document["sections"]
-                                    if section["section_number"] in st.session_state.selected_sections
+                                    if section["section_number"] in selected
                                 ]
                                 
-                                # Clear existing knowledge base and add new sections
-                                st.session_state.chat_client.knowledge_base = []
-                                st.session_state.chat_client.add_structured_knowledge(selected_sections, "PDF")
-                                st.success(f"Knowledge base updated with {len(selected_sections)} sections!")
-                                
                                 # Reset session if it was at limit
                                 if st.session_state.chat_client.get_question_count() >= st.session_state.chat_client.get_max_questions():
                                     st.session_state.chat_client.reset_session()
-                                    st.rerun()
+                                
+                                # Only add and remove the sections whose selection changed;
+                                # the conversation carries on with the new context
+                                st.session_state.chat_client.sync_structured_knowledge(selected_sections, "PDF")
+                                st.success(f"Knowledge base updated with {len(selected_sections)} sections!")
                             except Exception as e:
                                 st.error(f"Error updating sections: {str(e)}")
         
@@ -241,37 +266,35 @@ def main():
     # Always show suggested questions at the top
     st.info("You can ask questions about the e-bidding document. Here are some suggested questions:")
 
-    # Paired Thai and English questions
-    question_pairs = [
-        ("คุณสมบัติหลักของผู้ยื่นข้อเสนอ/ผู้เข้าร่วมประมูล มีอะไรบ้าง? (สรุป)", "What are the main qualifications of bidders/participants? (Summarized)"),
-        ("ผู้ยื่นข้อเสนอต้องแสดงหลักฐานทางการเงิน / หลักประกันการเสนอราคาเป็นจำนวนเท่าใด?", "How much financial proof / bid security must be provided?"),
-        ("หลักประกันการเสนอราคา / หลักฐานทางการเงินที่ยอมรับมีรูปแบบใดบ้าง?", "What are acceptable form of financial proof / bid security?"),
-        ("ผู้ยื่นข้อเสนอต้องมีผลงานหรือประสบการณ์ย้อนหลังกี่ปี?", "How many years of company background work or experience are required?"),
-        ("การตัดสินผู้ชนะพิจารณาจากราคาต่ำสุดหรือเกณฑ์การให้คะแนน?", "Is the winner determined by lowest price or scoring criteria?")
-    ]
-
     # Create columns for Thai and English questions
     cols = st.columns(2)
 
+    # One radio per language; picking an option queues it as the next question
     # Thai questions in the left column
     with cols[0]:
         st.subheader("คำถามภาษาไทย")
-        for thai_q, english_q in question_pairs:
-            if st.button(thai_q, key=f"thai_{hash(thai_q)}", use_container_width=True):
-                # Instead of processing directly, populate the chat input
-                st.session_state.pending_question = thai_q
-                st.session_state.pending_language = "thai"
-                st.rerun()
+        st.radio(
+            "คำถามภาษาไทย",
+            THAI_QUESTIONS,
+            index=None,
+            key="suggested_thai",
+            on_change=_queue_suggested_question,
+            args=("suggested_thai", "thai"),
+            label_visibility="collapsed"
+        )
 
     # English questions in the right column
     with cols[1]:
         st.subheader("English Questions")
-        for thai_q, english_q in question_pairs:
-            if st.button(english_q, key=f"english_{hash(english_q)}", use_container_width=True):
-                # Instead of processing directly, populate the chat input
-                st.session_state.pending_question = english_q
-                st.session_state.pending_language = "english"
-                st.rerun()
+        st.radio(
+            "English Questions",
+            ENGLISH_QUESTIONS,
+            index=None,
+            key="suggested_english",
+            on_change=_queue_suggested_question,
+            args=("suggested_english", "english"),
+            label_visibility="collapsed"
+        )
 
     # Display chat history
     for message in st.session_state.chat_client.conversation_history:
@@ -302,6 +325,21 @@ def main():
     if prompt:
         process_question(prompt, api_key, language)
 
+def _queue_suggested_question(widget_key, language):
+    """Queue a picked suggested question and clear the radio so it can be picked again"""
+    # Runs as an on_change callback, before the rerun, so no st.rerun() is needed
+    st.session_state.pending_question = st.session_state[widget_key]
+    st.session_state.pending_language = language
+    st.session_state[widget_key] = None
+
+def _show_stream_error(error_msg):
+    """Show the message of a ChatStreamError from the chat client"""
+    if "404" in error_msg:
+        st.error("Model or endpoint not found. Please check your model name and API configuration.")
+        st.error("Make sure your model is available in your DashScope account.")
+    else:
+        st.error(error_msg)
+
 def process_question(prompt, api_key, language="english"):
     """Process a question and generate a response"""
     # Display user message
@@ -322,24 +360,28 @@ def process_question(prompt, api_key, language="english"):
             logger.info(f"Sending message to API: {prompt}")
             stream = st.session_state.chat_client.chat_with_dashscope(prompt, language=language)
             
-            # Stream the response
-            for chunk in stream:
-                logger.debug(f"Received chunk from client: {repr(chunk)}")
-                # Check if there's an error in the chunk
-                if isinstance(chunk, str) and chunk.startswith("Error:"):
-                    if "404" in chunk:
-                        st.error("Model or endpoint not found. Please check your model name and API configuration.")
-                        st.error("Make sure your model is available in your DashScope account.")
-                    else:
-                        st.error(chunk)
-                    break
-                elif isinstance(chunk, str) and chunk.startswith("Session limit reached"):
-                    st.info(chunk)
-                    break
-                full_response += chunk
-                message_placeholder.markdown(full_response + "▌")
-                # Force UI to update immediately
-                time.sleep(0.01)
+            # Only format chunks for the log when debug logging is on
+            debug = logger.isEnabledFor(logging.DEBUG)
+            
+            # Stream the response. The client raises its notices instead of
+            # yielding them, so every chunk is reply text and none is checked
+            last_render = time.monotonic()
+            chunks_since_render = 0
+            try:
+                for chunk in stream:
+                    if debug:
+                        logger.debug(f"Received chunk from client: {repr(chunk)}")
+                    full_response += chunk
+                    chunks_since_render += 1
+                    now = time.monotonic()
+                    if chunks_since_render >= _RENDER_EVERY_CHUNKS or now - last_render >= _RENDER_INTERVAL:
+                        message_placeholder.markdown(full_response + "▌")
+                        last_render = now
+                        chunks_since_render = 0
+            except SessionLimitReached as notice:
+                st.info(str(notice))
+            except ChatStreamError as e:
+                _show_stream_error(str(e))
             
             # Final update
             message_placeholder.markdown(full_response)
@@ -8,26 +8,62 @@ import re
 import json
 import sys
 import fitz
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator, Union
 
 THAI_TO_ARABIC = {
     '๐': '0', '๑': '1', '๒': '2', '๓': '3', '๔': '4',
     '๕': '5', '๖': '6', '๗': '7', '๘': '8', '๙': '9'
 }
 
+_THAI_TRANS = str.maketrans(THAI_TO_ARABIC)
+
+# Header patterns: combined "๕. หลักประกันการเสนอราคา" and a standalone "๕."
+_COMBINED_RE = re.compile(r'^([๑-๙\d]+)\.\s+(.+)$')
+_STANDALONE_NUM_RE = re.compile(r'^[๑-๙\d]+\.$')
+
+# PyMuPDF's own mask for plain text, which already leaves images out. It is
+# pinned so the extracted text cannot shift with a library default: the
+# header patterns depend on its spacing, and glyphs without a Unicode
+# mapping (common in Thai government PDFs) keep their CID codes
+_TEXT_FLAGS = fitz.TEXTFLAGS_TEXT
+
 def thai_to_arabic_number(text: str) -> str:
-    result = text
-    for thai, arabic in THAI_TO_ARABIC.items():
-        result = result.replace(thai, arabic)
-    return result
+    # Thai digits are never ASCII, so ASCII text needs no translation
+    if text.isascii():
+        return text
+    return text.translate(_THAI_TRANS)
+
+def extract_text_pages(source: Union[str, bytes, memoryview]) -> Iterator[str]:
+    """Yield page text one page at a time from a file path or in-memory PDF bytes"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        doc = fitz.open(stream=source, filetype="pdf")
+    else:
+        doc = fitz.open(source)
+    try:
+        # Pages are extracted serially on purpose: PyMuPDF does not support
+        # multithreaded use and holds the GIL while extracting, so a thread
+        # pool would risk crashes without running pages in parallel
+        for page in doc:
+            yield page.get_text("text", flags=_TEXT_FLAGS) + "\n"
+    finally:
+        doc.close()
 
 def extract_text_from_pdf(pdf_path: str) -> str:
-    doc = fitz.open(pdf_path)
-    full_text = ""
-    for page in doc:
-        full_text += page.get_text() + "\n"
-    doc.close()
-    return full_text
+    return "".join(extract_text_pages(pdf_path))
+
+def split_lines(chunks: Iterable[str]) -> List[str]:
+    """
+    Split streamed text into lines, same result as ''.join(chunks).split('\n')
+    without ever holding the joined text
+    """
+    lines = []
+    carry = ""
+    for chunk in chunks:
+        chunk_lines = (carry + chunk).split('\n')
+        carry = chunk_lines.pop()
+        lines.extend(chunk_lines)
+    lines.append(carry)
+    return lines
 
 def normalize_text(text: str) -> str:
     """Normalize for comparison"""
@@ -67,30 +103,71 @@ CORE_KEYWORDS = {
     "13": ["ประเมินผล", "ปฏิบัติงาน", "ผู้ประกอบการ"],
 }
 
+# CORE_KEYWORDS passed through normalize_text once, at import
+CORE_KEYWORDS_NORM = {
+    section_num: tuple(normalize_text(kw) for kw in keywords)
+    for section_num, keywords in CORE_KEYWORDS.items()
+}
+
+# Every distinct keyword, so a line is searched for each one only once and
+# sections then match by subset ("ข้อเสนอ", "การเสนอราคา" are shared)
+_SECTION_KEYWORD_SETS = {
+    section_num: frozenset(keywords)
+    for section_num, keywords in CORE_KEYWORDS_NORM.items()
+}
+_ALL_KEYWORDS = frozenset().union(*_SECTION_KEYWORD_SETS.values())
+
+# Titles that are too long for section 4 ("การเสนอราคา") or 7 ("การทำสัญญา"),
+# which would otherwise also match longer subsection text
+_MAX_TITLE_LENGTHS = {"4": 20, "7": 25}
+
+# Normalized title length range (min inclusive, max exclusive) per section.
+# A title shorter than its section's longest keyword cannot contain it, so
+# most lines are rejected before any keyword is searched for
+_SECTION_LENGTH_BOUNDS = {
+    section_num: (max(len(kw) for kw in keywords), _MAX_TITLE_LENGTHS.get(section_num, sys.maxsize))
+    for section_num, keywords in CORE_KEYWORDS_NORM.items()
+}
+
 def title_matches_section(title: str, section_num: str) -> bool:
     """
     Check if a title matches the expected section using strict rules
     """
-    if section_num not in CORE_KEYWORDS:
+    return _title_norm_matches_section(normalize_text(title), section_num)
+
+def _title_norm_matches_section(title_norm: str, section_num: str) -> bool:
+    """
+    title_matches_section for a title already passed through normalize_text
+    """
+    if section_num not in CORE_KEYWORDS_NORM:
         return False
     
-    title_norm = normalize_text(title)
-    keywords = CORE_KEYWORDS[section_num]
+    min_len, max_len = _SECTION_LENGTH_BOUNDS[section_num]
+    if not min_len <= len(title_norm) < max_len:
+        return False
     
     # All keywords must be present
-    all_present = all(normalize_text(kw) in title_norm for kw in keywords)
+    all_present = all(kw in title_norm for kw in CORE_KEYWORDS_NORM[section_num])
     
     if not all_present:
         return False
     
+    return _passes_section_rules(title_norm, section_num)
+
+def _keyword_hits(title_norm: str) -> frozenset:
+    """Keywords from any section that appear in a normalized title"""
+    return frozenset(kw for kw in _ALL_KEYWORDS if kw in title_norm)
+
+def _passes_section_rules(title_norm: str, section_num: str) -> bool:
+    """
+    Extra rules for sections whose keywords alone are ambiguous; the
+    caller has already checked _SECTION_LENGTH_BOUNDS
+    """
     # Additional checks for ambiguous cases
     if section_num == "4":
         # Must be "การเสนอราคา" and NOT "หลักประกันการเสนอราคา"
-        return "หลักประกัน" not in title_norm and len(title_norm) < 20
-    
-    if section_num == "7":
-        # Should be just "การทำสัญญา" possibly with "เช่า"
-        return len(title_norm) < 25
+        # (length is capped by _SECTION_LENGTH_BOUNDS)
+        return "หลักประกัน" not in title_norm
     
     if section_num == "11":
         # Should contain "ข้อสงวนสิทธิ์"
@@ -98,105 +175,128 @@ def title_matches_section(title: str, section_num: str) -> bool:
     
     return True
 
-def has_section_number_nearby(lines: List[str], title_line_idx: int, section_num: str) -> Tuple[bool, int]:
+def has_section_number_nearby(standalone: Dict[int, str], title_line_idx: int, section_num: str) -> Tuple[bool, int]:
     """
     Check if the section number appears within 2 lines before OR after the title.
+    standalone maps line index to the number of each standalone "๕." line.
     Returns: (found, line_number_of_section_num)
     """
     # Check lines BEFORE the title (up to 2 lines)
-    for offset in range(1, min(3, title_line_idx + 1)):
-        check_idx = title_line_idx - offset
-        if check_idx < 0:
-            break
-        
-        line = lines[check_idx].strip()
-        
-        # Pattern: Standalone number "๕."
-        if re.match(r'^[๑-๙\d]+\.$', line):
-            num = thai_to_arabic_number(line.rstrip('.'))
-            if num == section_num:
-                return (True, check_idx)
+    for check_idx in (title_line_idx - 1, title_line_idx - 2):
+        if standalone.get(check_idx) == section_num:
+            return (True, check_idx)
     
     # Check lines AFTER the title (up to 2 lines) - THIS IS KEY FOR THIS DOCUMENT!
-    for offset in range(1, min(3, len(lines) - title_line_idx)):
-        check_idx = title_line_idx + offset
-        if check_idx >= len(lines):
-            break
-        
-        line = lines[check_idx].strip()
-        
-        # Pattern: Standalone number "๕."
-        if re.match(r'^[๑-๙\d]+\.$', line):
-            num = thai_to_arabic_number(line.rstrip('.'))
-            if num == section_num:
-                # Use title line as the reference point
-                return (True, title_line_idx)
+    for check_idx in (title_line_idx + 1, title_line_idx + 2):
+        if standalone.get(check_idx) == section_num:
+            # Use title line as the reference point
+            return (True, title_line_idx)
     
     return (False, -1)
 
-def find_section_by_title_scan(lines: List[str]) -> List[Dict]:
+# Per-line views of a document: stripped text, normalize_text form, indent
+# width, and the number of every standalone "๕." line by line index
+LineViews = Tuple[List[str], List[str], List[int], Dict[int, str]]
+
+def line_views(lines: List[str]) -> LineViews:
+    """
+    Build the LineViews of every line in one pass
+    """
+    stripped = []
+    normalized = []
+    indents = []
+    standalone = {}
+    for i, line in enumerate(lines):
+        line_clean = line.strip()
+        stripped.append(line_clean)
+        normalized.append(' '.join(line_clean.lower().split()))
+        indents.append(len(line) - len(line.lstrip()))
+        if _STANDALONE_NUM_RE.match(line_clean):
+            standalone[i] = thai_to_arabic_number(line_clean.rstrip('.'))
+    return stripped, normalized, indents, standalone
+
+def find_section_by_title_scan(lines: List[str], views: Optional[LineViews] = None) -> List[Dict]:
     """
     Find sections by scanning for title lines that match expected titles
     AND have the corresponding section number nearby
     """
+    if views is None:
+        views = line_views(lines)
+    stripped, normalized, indents, standalone = views
     headers = []
-    found_sections = set()
+    # Still-unfound sections, in section order. Each keeps the first line
+    # that qualifies for it, so one pass over the lines finds them all and
+    # the pass stops as soon as none are left
+    remaining = [str(section_num) for section_num in range(1, 14)]
     
-    for section_num in range(1, 14):
-        section_str = str(section_num)
-        expected_title = EXPECTED_TITLES[section_str]
-        
-        for i, line in enumerate(lines):
-            line_clean = line.strip()
+    for i, line_clean in enumerate(stripped):
+        # Pattern 1: Combined format "๕. หลักประกันการเสนอราคา"
+        combined_match = _COMBINED_RE.match(line_clean)
+        if combined_match:
+            # Only the section whose number prefixes the line can match it
+            section_str = thai_to_arabic_number(combined_match.group(1))
+            title_part = combined_match.group(2).strip()
             
-            # Skip if already found
-            if section_str in found_sections:
+            if section_str in remaining and title_matches_section(title_part, section_str):
+                # Additional check: make sure this is not a subsection
+                # Main sections should have minimal indentation
+                if indents[i] < 25:  # Main sections have less indentation
+                    headers.append({
+                        'line': i,
+                        'number': section_str,
+                        'title': title_part
+                    })
+                    remaining.remove(section_str)
+        
+        # Pattern 2: Title only, number on previous line
+        elif len(line_clean) > 10:
+            # One normalized form for every section still being looked
+            # for; a line may be the header of more than one of them
+            title_norm = normalized[i]
+            title_len = len(title_norm)
+            hits = _keyword_hits(title_norm)
+            if not hits:
                 continue
-            
-            # Pattern 1: Combined format "๕. หลักประกันการเสนอราคา"
-            combined_match = re.match(r'^([๑-๙\d]+)\.\s+(.+)$', line_clean)
-            if combined_match:
-                num_part = thai_to_arabic_number(combined_match.group(1))
-                title_part = combined_match.group(2).strip()
+            for section_str in list(remaining):
+                min_len, max_len = _SECTION_LENGTH_BOUNDS[section_str]
+                if not (min_len <= title_len < max_len
+                        and _SECTION_KEYWORD_SETS[section_str] <= hits
+                        and _passes_section_rules(title_norm, section_str)):
+                    continue
                 
-                if num_part == section_str and title_matches_section(title_part, section_str):
-                    # Additional check: make sure this is not a subsection
-                    # Main sections should have minimal indentation
-                    indent = len(line) - len(line.lstrip())
-                    if indent < 25:  # Main sections have less indentation
-                        headers.append({
-                            'line': i,
-                            'number': section_str,
-                            'title': title_part
-                        })
-                        found_sections.add(section_str)
-                        break
-            
-            # Pattern 2: Title only, number on previous line
-            elif len(line_clean) > 10 and title_matches_section(line_clean, section_str):
                 # CRITICAL: Must have section number nearby
-                has_num, num_line = has_section_number_nearby(lines, i, section_str)
+                has_num, num_line = has_section_number_nearby(standalone, i, section_str)
                 
                 if has_num:
                     # Check indentation
-                    indent = len(lines[num_line]) - len(lines[num_line].lstrip())
-                    if indent < 25:
+                    if indents[num_line] < 25:
                         headers.append({
                             'line': num_line,
                             'number': section_str,
                             'title': line_clean
                         })
-                        found_sections.add(section_str)
-                        break
+                        remaining.remove(section_str)
         
-    return sorted(headers, key=lambda x: x['line'])
+        # Every section has its header; the rest of the document is content
+        if not remaining:
+            break
+    
+    # Ties on the same line keep section order
+    return sorted(headers, key=lambda x: (x['line'], int(x['number'])))
 
-def parse_document(text: str) -> Dict:
-    """Parse document"""
-    lines = text.split('\n')
+def parse_document(text: Union[str, Iterable[str]]) -> Dict:
+    """Parse document from its full text or from an iterable of page texts"""
+    if isinstance(text, str):
+        lines = text.split('\n')
+    else:
+        lines = split_lines(text)
+    
+    # Strip, normalize and measure every line once
+    views = line_views(lines)
+    stripped, normalized = views[0], views[1]
     
     # Find headers
-    headers = find_section_by_title_scan(lines)
+    headers = find_section_by_title_scan(lines, views)
     
     # Check missing
     found = set(h['number'] for h in headers)
@@ -219,8 +319,7 @@ def parse_document(text: str) -> Dict:
         content_start = start_line + 1
         # If title is on separate line from number, skip both
         if start_line + 1 < len(lines):
-            next_line = lines[start_line + 1].strip()
-            if next_line and normalize_text(next_line) == normalize_text(header['title']):
+            if stripped[start_line + 1] and normalized[start_line + 1] == normalize_text(header['title']):
                 content_start = start_line + 2
         
         content_lines = lines[content_start:end_line]